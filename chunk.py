@@ -1,139 +1,325 @@
 import boto3
+import botocore.parsers
+import numpy as np
+import html
+import io
 import time
 import json
 import sys
+import types
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+
+import chunk_cache
+from md_utils import md_table
+
+try:
+    import orjson
+except ImportError:  # Optional: botocore keeps using stdlib json without it
+    orjson = None
 
 # --- CONFIGURATION ---
 BUCKET_NAME = "your-s3-bucket-name"
 DOCUMENT_KEY = "folder/your-large-document.pdf" 
 REGION = "us-east-1" # Change to your AWS region
 
-# Initialize Client
-textract_client = boto3.client('textract', region_name=REGION)
+# Textract result pages are multi-MB JSON bodies; parse them with orjson when available.
+# botocore's JSON parsers only call json.loads() and treat ValueError as a
+# non-JSON body, which orjson.JSONDecodeError subclasses.
+if orjson is not None:
+    botocore.parsers.json = types.SimpleNamespace(loads=orjson.loads, dumps=json.dumps)
+
+# Initialize Client (thread-safe, shared by all workers)
+# - pool sized for concurrent jobs, keepalive avoids a TLS handshake per poll
+# - adaptive retries back off client-side when Textract throttles
+#   (GetDocumentAnalysis defaults to a low TPS quota)
+textract_client = boto3.client('textract', region_name=REGION, config=Config(
+    max_pool_connections=64,
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True,
+))
+
+# Layout blocks that carry readable text (others, e.g. LAYOUT_FIGURE, are skipped)
+LAYOUT_CONTENT_TYPES = frozenset(['LAYOUT_TITLE', 'LAYOUT_HEADER', 'LAYOUT_SECTION_HEADER', 'LAYOUT_TEXT', 'LAYOUT_LIST'])
 
 # ==========================================
 # PART 1: The Parser (Layout-Aware Logic)
 # ==========================================
-def parse_textract_layout_to_chunks(textract_response, document_id):
+
+# One table cell: 1-based row/column, row/column span, joined word text
+Cell = namedtuple('Cell', 'r c rs cs text')
+
+class TextractIndex:
+    """
+    Incremental index over Textract blocks, built one result page at a time
+    so the full block list never has to be materialized.
+    Buckets blocks by BlockType and precomputes the word lookups the parser needs.
+    """
+    def __init__(self):
+        self.block_map = {}
+        self.type_index = defaultdict(list)
+        # Layout blocks share one bucket to keep their original reading order.
+        self.layout_blocks = []
+        # cell_id -> (word texts, word id set)
+        self.cell_info = {}
+        # layout_id -> word ids of its LINE children, in reading order
+        self.layout_word_ids = {}
+        self._pending_cells = []
+
+    def __len__(self):
+        return len(self.block_map)
+
+    def add_page(self, blocks):
+        block_map = self.block_map
+        type_index = self.type_index
+        layout_blocks = self.layout_blocks
+        pending_cells = self._pending_cells
+        for b in blocks:
+            block_map[b['Id']] = b
+            btype = b['BlockType']
+            # WORD blocks (most of the document) are only ever reached by Id
+            if btype == 'WORD':
+                continue
+            type_index[btype].append(b)
+            if btype in LAYOUT_CONTENT_TYPES:
+                layout_blocks.append(b)
+            elif btype == 'CELL':
+                # A cell's words may arrive on a later page; resolve in finalize()
+                pending_cells.append(b)
+
+    def finalize(self):
+        """Resolves CELL -> WORD references. Call once all pages are added."""
+        # Kept as a plain loop on purpose: it costs ~55 ms per 80k blocks,
+        # less than Numba's import + JIT compile (~0.8 s), and any array
+        # (SoA) encoding would still need a Python pass over the dicts.
+        block_map = self.block_map
+        for cell in self._pending_cells:
+            words = []
+            word_ids = set()
+            for rel in cell.get('Relationships', ()):
+                if rel['Type'] == 'CHILD':
+                    for wid in rel['Ids']:
+                        child = block_map[wid]
+                        if child['BlockType'] == 'WORD':
+                            words.append(child['Text'])
+                            word_ids.add(wid)
+            self.cell_info[cell['Id']] = (words, word_ids)
+        self._pending_cells = []
+
+        # Child LINEs may also arrive on a later page than their layout block
+        for block in self.layout_blocks:
+            if block['Id'] in self.layout_word_ids:
+                continue
+            wids = []
+            for rel in block.get('Relationships', ()):
+                if rel['Type'] == 'CHILD':
+                    for child_id in rel['Ids']:
+                        child = block_map.get(child_id)
+                        if child and child['BlockType'] == 'LINE':
+                            for line_rel in child.get('Relationships', ()):
+                                if line_rel['Type'] == 'CHILD':
+                                    wids.extend(line_rel['Ids'])
+            self.layout_word_ids[block['Id']] = wids
+        return self
+
+def _table_to_markdown(cells_data, max_row, max_col):
+    """
+    Renders table cells as a Markdown grid. Markdown has no merged cells,
+    so a spanned cell's text is replicated into every slot it covers.
+    """
+    # 1. Lay out rows (spans, gaps, duplicates or unusual order need the grid)
+    rows_list = _dense_rows(cells_data, max_row, max_col)
+    if rows_list is None:
+        rows_list = _fill_grid(cells_data, max_row, max_col)
+
+    # 2. Generate Markdown
+    return md_table(rows_list)
+
+def _dense_rows(cells_data, max_row, max_col):
+    """
+    Returns the rows of text directly when the cells are exactly one unmerged
+    cell per slot in row-major order (how Textract lists a plain table; empty
+    cells still get a CELL block), else None. One pass, no sort and no grid.
+    """
+    if len(cells_data) != max_row * max_col:
+        return None
+    r = 1
+    col = 1
+    texts = []
+    for c in cells_data:
+        if c.r != r or c.c != col or c.rs != 1 or c.cs != 1:
+            return None
+        texts.append(c.text)
+        col += 1
+        if col > max_col:
+            col = 1
+            r += 1
+    return [texts[i:i + max_col] for i in range(0, len(texts), max_col)]
+
+def _fill_grid(cells_data, max_row, max_col):
+    """
+    Places cells on a max_row x max_col grid and returns it as nested lists.
+    Where cells overlap (wonky Textract spans or duplicate anchors), the cell
+    that comes later in TABLE child order wins. Slices clip spans that run
+    past the grid.
+    """
+    grid = np.full((max_row, max_col), '', dtype=object)
+    rows = np.fromiter((c.r for c in cells_data), dtype=np.int32, count=len(cells_data))
+    cols = np.fromiter((c.c for c in cells_data), dtype=np.int32, count=len(cells_data))
+    slots = (rows - 1) * max_col + (cols - 1)
+
+    has_span = any(c.rs > 1 or c.cs > 1 for c in cells_data)
+    if not has_span and len(np.unique(slots)) == len(slots):
+        # No overlaps possible, so order does not matter: one fancy-index assignment
+        texts = np.empty(len(cells_data), dtype=object)
+        texts[:] = [c.text for c in cells_data]
+        grid[rows - 1, cols - 1] = texts
+    else:
+        # Fill in cell order so overlaps resolve exactly as listed by Textract
+        for c in cells_data:
+            grid[c.r - 1:c.r - 1 + c.rs, c.c - 1:c.c - 1 + c.cs] = c.text
+    return grid.tolist()
+
+def _table_to_html(cells_data, max_row):
+    """
+    Renders table cells as an HTML table. Merged cells are emitted once
+    with rowspan/colspan. Missing slots become empty <td>s so later cells
+    keep their column; a duplicate anchor keeps the later cell (as in
+    Markdown), and an anchor inside another cell's span is dropped.
+    """
+    anchors = {}
+    for c in cells_data:
+        anchors[(c.r, c.c)] = c
+    rows = [[] for _ in range(max_row)]
+    for (r, _), c in sorted(anchors.items()):
+        rows[r - 1].append(c)
+    # Per row, the columns already taken by rowspans from the rows above
+    covered = [set() for _ in range(max_row)]
+
+    buf = io.StringIO()
+    buf.write("<table>")
+    for i, row in enumerate(rows):
+        taken = covered[i]
+        col = 1
+        buf.write("<tr>")
+        for c in row:
+            if c.c < col or c.c in taken:
+                continue
+            while col < c.c:
+                if col not in taken:
+                    buf.write("<td></td>")
+                col += 1
+            buf.write("<td")
+            if c.rs > 1:
+                buf.write(f' rowspan="{c.rs}"')
+                for below in covered[i + 1:i + c.rs]:
+                    below.update(range(c.c, c.c + c.cs))
+            if c.cs > 1:
+                buf.write(f' colspan="{c.cs}"')
+            buf.write(">" + html.escape(c.text) + "</td>")
+            col = c.c + c.cs
+        buf.write("</tr>")
+    buf.write("</table>")
+    return buf.getvalue()
+
+def parse_textract_layout_to_chunks(textract_response, document_id, table_format='md'):
     """
     Parses Textract JSON using Layout Analysis (if available).
+    Accepts either a raw response ({'Blocks': [...]}) or a TextractIndex.
+    Tables are serialized as Markdown (table_format='md') or as HTML
+    (table_format='html'), which keeps merged cells as rowspan/colspan.
     Injects 'document_id' into every chunk for Vector DB filtering.
     """
-    blocks = textract_response['Blocks']
-    block_map = {b['Id']: b for b in blocks}
+    if table_format not in ('md', 'html'):
+        raise ValueError(f"Unsupported table_format: {table_format!r}")
+
+    if isinstance(textract_response, TextractIndex):
+        idx = textract_response
+    else:
+        idx = TextractIndex()
+        idx.add_page(textract_response['Blocks'])
+    idx.finalize()
+
+    block_map = idx.block_map
+    type_index = idx.type_index
+    layout_blocks = idx.layout_blocks
+    cell_info = idx.cell_info
+    layout_word_ids = idx.layout_word_ids
     
     chunks = []
     consumed_word_ids = set() 
 
     # --- Step A: Extract Tables (High Value) ---
-    for block in blocks:
-        if block['BlockType'] == 'TABLE':
-            # Safety Check: Ensure table has children (cells)
-            if 'Relationships' not in block:
-                continue
-            
-            # Extract Cell IDs safely
-            cell_ids = []
-            for rel in block['Relationships']:
-                if rel['Type'] == 'CHILD':
-                    cell_ids = rel['Ids']
-                    break
-            
-            if not cell_ids:
-                continue
+    for block in type_index['TABLE']:
+        # Safety Check: Ensure table has children (cells)
+        if 'Relationships' not in block:
+            continue
+        
+        # Extract Cell IDs safely
+        cell_ids = []
+        for rel in block['Relationships']:
+            if rel['Type'] == 'CHILD':
+                cell_ids = rel['Ids']
+                break
+        
+        if not cell_ids:
+            continue
 
-            cells_data = []
+        cells_data = []
+        cell_word_ids = []
+        
+        for cell_id in cell_ids:
+            cell = block_map[cell_id]
+            words, wid_set = cell_info[cell_id]
+            cell_word_ids.append(wid_set)
             
-            for cell_id in cell_ids:
-                cell = block_map[cell_id]
-                cell_text_words = []
-                if 'Relationships' in cell:
-                    for rel in cell['Relationships']:
-                        if rel['Type'] == 'CHILD':
-                            for wid in rel['Ids']:
-                                if block_map[wid]['BlockType'] == 'WORD':
-                                    cell_text_words.append(block_map[wid]['Text'])
-                                    consumed_word_ids.add(wid)
-                
-                cells_data.append({
-                    'r': cell['RowIndex'], 
-                    'c': cell['ColumnIndex'],
-                    'rs': cell.get('RowSpan', 1),
-                    'cs': cell.get('ColumnSpan', 1),
-                    'text': " ".join(cell_text_words)
-                })
+            cells_data.append(Cell(
+                cell['RowIndex'],
+                cell['ColumnIndex'],
+                cell.get('RowSpan', 1),
+                cell.get('ColumnSpan', 1),
+                " ".join(words)
+            ))
 
-            if not cells_data: continue
-            
-            # Build Markdown Table with Merged Cell Support
-            # 1. Calculate grid dimensions taking spans into account
-            max_row = 0
-            max_col = 0
-            for c in cells_data:
-                max_row = max(max_row, c['r'] + c['rs'] - 1)
-                max_col = max(max_col, c['c'] + c['cs'] - 1)
-
-            grid = [['' for _ in range(max_col)] for _ in range(max_row)]
-            
-            # 2. Fill grid, replicating text for merged cells
-            for c in cells_data:
-                text = c['text']
-                r_start = c['r'] - 1
-                c_start = c['c'] - 1
-                
-                for r_offset in range(c['rs']):
-                    for c_offset in range(c['cs']):
-                        # Avoid out of bounds if Textract data is wonky
-                        if r_start + r_offset < max_row and c_start + c_offset < max_col:
-                            grid[r_start + r_offset][c_start + c_offset] = text
-            
-            # 3. Generate Markdown
-            md_lines = ["| " + " | ".join(grid[0]) + " |", "| " + " | ".join(['---'] * max_col) + " |"]
-            for row in grid[1:]: md_lines.append("| " + " | ".join(row) + " |")
-            
-            chunks.append({
-                "text": "\n".join(md_lines),
-                "metadata": {
-                    "document_id": document_id,
-                    "page": block.get('Page', 1),
-                    "type": "table"
-                }
-            })
+        # Mark the whole table's words consumed in one C-level union
+        consumed_word_ids.update(*cell_word_ids)
+
+        if not cells_data: continue
+        
+        # Calculate grid dimensions taking spans into account
+        max_row = 0
+        max_col = 0
+        for c in cells_data:
+            max_row = max(max_row, c.r + c.rs - 1)
+            max_col = max(max_col, c.c + c.cs - 1)
+
+        if table_format == 'html':
+            table_text = _table_to_html(cells_data, max_row)
+        else:
+            table_text = _table_to_markdown(cells_data, max_row, max_col)
+        
+        chunks.append({
+            "text": table_text,
+            "metadata": {
+                "document_id": document_id,
+                "page": block.get('Page', 1),
+                "type": "table"
+            }
+        })
 
     # --- Step B: Extract Layout Text ---
-    layout_content_types = ['LAYOUT_TITLE', 'LAYOUT_HEADER', 'LAYOUT_SECTION_HEADER', 'LAYOUT_TEXT', 'LAYOUT_LIST']
-    layout_blocks = [b for b in blocks if b['BlockType'] in layout_content_types]
-    
     if layout_blocks:
         for block in layout_blocks:
-            block_lines = []
-            if 'Relationships' in block:
-                for rel in block['Relationships']:
-                    if rel['Type'] == 'CHILD':
-                        for child_id in rel['Ids']:
-                            child = block_map.get(child_id)
-                            if child and child['BlockType'] == 'LINE':
-                                block_lines.append(child)
-            
-            total_words = 0
-            consumed_count = 0
-            block_text_parts = []
-            
-            for line in block_lines:
-                if 'Relationships' in line:
-                    for rel in line['Relationships']:
-                        if rel['Type'] == 'CHILD':
-                            for wid in rel['Ids']:
-                                total_words += 1
-                                if wid in consumed_word_ids:
-                                    consumed_count += 1
-                                elif block_map.get(wid):
-                                     block_text_parts.append(block_map[wid]['Text'])
+            wids = layout_word_ids[block['Id']]
 
             # Overlap check: if >50% of words are in a table, skip this block
-            if total_words > 0 and (consumed_count / total_words) > 0.5:
+            if len(consumed_word_ids.intersection(wids)) * 2 > len(wids):
                 continue
 
+            block_text_parts = [block_map[wid]['Text'] for wid in wids
+                                if wid not in consumed_word_ids and wid in block_map]
+
             full_text = " ".join(block_text_parts)
             if full_text.strip():
                 chunks.append({
@@ -151,26 +337,27 @@ def parse_textract_layout_to_chunks(textract_response, document_id):
         last_top = 0
         current_page = 1
         
-        for block in blocks:
-            if block['BlockType'] == 'LINE':
-                # Deduplication check
-                if 'Relationships' in block:
-                    wids = [id for rel in block['Relationships'] for id in rel['Ids']]
-                    if sum(1 for w in wids if w in consumed_word_ids) > len(wids)/2:
-                        continue
-                
-                top = block['Geometry']['BoundingBox']['Top']
-                # Paragraph Break Heuristic (5% vertical gap)
-                if current_text and (abs(top - last_top) > 0.05 or block.get('Page') != current_page):
-                    chunks.append({
-                        "text": " ".join(current_text), 
-                        "metadata": {"document_id": document_id, "page": current_page, "type": "text_block"}
-                    })
-                    current_text = []
-                
-                current_text.append(block['Text'])
-                last_top = top
-                current_page = block.get('Page', 1)
+        for block in type_index['LINE']:
+            # Deduplication check: skip lines mostly covered by a table
+            # (word id sets are only built here, and only if a table exists)
+            if consumed_word_ids:
+                wid_set = {wid for rel in block.get('Relationships', ()) for wid in rel['Ids']}
+                if len(wid_set & consumed_word_ids) * 2 > len(wid_set):
+                    continue
+            
+            top = block['Geometry']['BoundingBox']['Top']
+            # Paragraph Break Heuristic (5% vertical gap)
+            page = block.get('Page', 1)
+            if current_text and (abs(top - last_top) > 0.05 or page != current_page):
+                chunks.append({
+                    "text": " ".join(current_text), 
+                    "metadata": {"document_id": document_id, "page": current_page, "type": "text_block"}
+                })
+                current_text = []
+            
+            current_text.append(block['Text'])
+            last_top = top
+            current_page = page
         
         if current_text:
             chunks.append({"text": " ".join(current_text), "metadata": {"document_id": document_id, "page": current_page, "type": "text_block"}})
@@ -189,46 +376,95 @@ def start_job(bucket, key):
     )
     return response['JobId']
 
-def get_full_results(job_id):
+def wait_for_job(job_id, initial_poll=1.0, max_poll=15.0, poll_multiplier=1.5):
     """
-    Polls for completion and then paginates to get ALL blocks.
+    Polls until the job leaves IN_PROGRESS.
+    The poll interval starts at `initial_poll` seconds and grows by
+    `poll_multiplier` up to `max_poll`; raise these when many jobs are
+    polled concurrently to stay under the GetDocumentAnalysis TPS limit.
     """
     print(f"Waiting for Job {job_id} to complete...", end='')
     
-    # 1. Polling Loop
+    sleep_s = initial_poll
     while True:
         response = textract_client.get_document_analysis(JobId=job_id)
         status = response['JobStatus']
         
         if status == 'SUCCEEDED':
             print("\nJob Succeeded! Fetching results...")
-            break
+            return
         elif status == 'FAILED':
             print(f"\nJob Failed: {response}")
-            sys.exit(1)
+            raise RuntimeError(f"Textract job {job_id} failed: {response.get('StatusMessage')}")
         else:
             print(".", end='', flush=True)
-            time.sleep(5) # Check every 5 seconds
+            time.sleep(sleep_s)
+            sleep_s = min(sleep_s * poll_multiplier, max_poll)
 
-    # 2. Pagination Loop (The Aggregator)
-    blocks = []
-    next_token = None
-    
-    while True:
+def iter_result_pages(job_id):
+    """
+    Yields the 'Blocks' list of each result page of a finished job.
+    The next page is fetched in the background while the caller
+    processes the current one.
+    """
+    def fetch(next_token):
         # Only request MaxResults and NextToken if they exist
         kwargs = {'JobId': job_id, 'MaxResults': 1000}
         if next_token:
             kwargs['NextToken'] = next_token
+        return textract_client.get_document_analysis(**kwargs)
+
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        response = fetch(None)
+        while True:
+            next_token = response.get('NextToken')
+            pending = prefetcher.submit(fetch, next_token) if next_token else None
+            yield response['Blocks']
+            if pending is None:
+                break
+            response = pending.result()
+
+def get_full_results(job_id, initial_poll=1.0, max_poll=15.0, poll_multiplier=1.5):
+    """
+    Polls for completion and then paginates to get ALL blocks,
+    indexing each page as it arrives. Returns a TextractIndex.
+    """
+    # 1. Polling Loop (exponential backoff)
+    wait_for_job(job_id, initial_poll, max_poll, poll_multiplier)
+
+    # 2. Pagination Loop (The Aggregator)
+    idx = TextractIndex()
+    for page_blocks in iter_result_pages(job_id):
+        idx.add_page(page_blocks)
             
-        response = textract_client.get_document_analysis(**kwargs)
-        blocks.extend(response['Blocks'])
-        
-        next_token = response.get('NextToken')
-        if not next_token:
-            break
-            
-    print(f"Retrieved {len(blocks)} total blocks from Textract.")
-    return {'Blocks': blocks}
+    print(f"Retrieved {len(idx)} total blocks from Textract.")
+    return idx.finalize()
+
+def process_documents(keys, bucket=BUCKET_NAME, max_workers=8, **poll_kwargs):
+    """
+    Runs the Textract flow for several PDFs concurrently.
+    Returns ({key: chunks}, {key: exception}); a failed document is reported
+    in the second dict without discarding the others. Keep `max_workers`
+    within the account's GetDocumentAnalysis TPS quota (and raise the poll
+    intervals to match).
+    """
+    def process_one(key):
+        job_id = start_job(bucket, key)
+        textract_index = get_full_results(job_id, **poll_kwargs)
+        return parse_textract_layout_to_chunks(textract_index, key.split('/')[-1])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {key: pool.submit(process_one, key) for key in keys}
+
+    results = {}
+    errors = {}
+    for key, future in futures.items():
+        error = future.exception()
+        if error is None:
+            results[key] = future.result()
+        else:
+            errors[key] = error
+    return results, errors
 
 # ==========================================
 # PART 3: Main Execution
@@ -259,20 +495,46 @@ if __name__ == "__main__":
             from docx_parser import parse_docx_to_chunks
             
             doc_id = DOCUMENT_KEY.split('/')[-1]
-            vector_ready_chunks = parse_docx_to_chunks(local_filename, doc_id)
+            cache_key = None
+            vector_ready_chunks = None
+            if chunk_cache.enabled():
+                cache_key = chunk_cache.cache_key(doc_id, chunk_cache.file_fingerprint(local_filename))
+                vector_ready_chunks = chunk_cache.get(cache_key)
+            
+            if vector_ready_chunks is None:
+                vector_ready_chunks = parse_docx_to_chunks(local_filename, doc_id)
+                if cache_key:
+                    chunk_cache.put(cache_key, vector_ready_chunks)
+            else:
+                print("Cache hit: reusing previously parsed chunks.")
             
         else:
             # PDF / Textract Flow
-            job_id = start_job(BUCKET_NAME, DOCUMENT_KEY)
-            
-            # 2. Wait & Aggregate
-            full_response = get_full_results(job_id)
-            
-            # 3. Parse
             # Use filename as ID, or generate a UUID here
             doc_id = DOCUMENT_KEY.split('/')[-1] 
             
-            vector_ready_chunks = parse_textract_layout_to_chunks(full_response, doc_id)
+            # Skip Textract entirely if this exact PDF (by S3 ETag) was already parsed.
+            # Only look up the ETag when the cache is live, to avoid a needless S3 call.
+            cache_key = None
+            vector_ready_chunks = None
+            if chunk_cache.enabled():
+                s3 = boto3.client('s3', region_name=REGION)
+                etag = s3.head_object(Bucket=BUCKET_NAME, Key=DOCUMENT_KEY)['ETag'].strip('"')
+                cache_key = chunk_cache.cache_key(doc_id, etag)
+                vector_ready_chunks = chunk_cache.get(cache_key)
+            
+            if vector_ready_chunks is None:
+                job_id = start_job(BUCKET_NAME, DOCUMENT_KEY)
+                
+                # 2. Wait & Aggregate
+                textract_index = get_full_results(job_id)
+                
+                # 3. Parse
+                vector_ready_chunks = parse_textract_layout_to_chunks(textract_index, doc_id)
+                if cache_key:
+                    chunk_cache.put(cache_key, vector_ready_chunks)
+            else:
+                print("Cache hit: reusing previously parsed chunks.")
         
         # 4. Output / Load to Vector DB
         print(f"\n--- Success! Created {len(vector_ready_chunks)} Chunks ---")
@@ -284,3 +546,4 @@ if __name__ == "__main__":
 
     except Exception as e:
         print(f"\nError: {str(e)}")
+        sys.exit(1)
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+
+try:
+    import redis
+except ImportError:  # Optional: without redis the cache is a no-op
+    redis = None
+
+# Bump when parser output or Textract FeatureTypes change, so stale chunks are not reused
+FEATURE_VERSION = "tables-layout-v1"
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+CACHE_TTL = int(os.environ.get('TEXTRACT_CACHE_TTL', 7 * 24 * 3600))  # seconds
+# Keep a slow or blackholed Redis from stalling the pipeline; a miss is cheap
+REDIS_TIMEOUT = float(os.environ.get('REDIS_TIMEOUT', 0.5))  # seconds
+
+_client = None
+_disabled = redis is None
+
+def _get_client():
+    """
+    Lazily connects to Redis. Returns None if redis is not installed,
+    REDIS_URL is malformed or the server is unreachable (checked once
+    per process).
+    """
+    global _client, _disabled
+    if _client is None and not _disabled:
+        try:
+            client = redis.Redis.from_url(REDIS_URL,
+                                          socket_connect_timeout=REDIS_TIMEOUT,
+                                          socket_timeout=REDIS_TIMEOUT)
+            client.ping()
+            _client = client
+        except (redis.RedisError, ValueError) as e:
+            print(f"Chunk cache disabled: {e}")
+            _disabled = True
+    return _client
+
+def enabled():
+    """True if a Redis server is reachable, i.e. get/put are not no-ops."""
+    return _get_client() is not None
+
+def file_fingerprint(path):
+    """SHA-256 of a local file, read in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_key(document_id, fingerprint):
+    """
+    Builds the cache key for a document. `fingerprint` identifies the source
+    content, e.g. file_fingerprint() of a local file or the S3 ETag.
+    """
+    return f"textract:{document_id}:{fingerprint}:{FEATURE_VERSION}"
+
+def get(key):
+    """Returns the cached chunks for `key`, or None on a miss."""
+    client = _get_client()
+    if client is None:
+        return None
+    try:
+        cached = client.get(key)
+    except redis.RedisError:
+        return None
+    return json.loads(cached) if cached is not None else None
+
+def put(key, chunks):
+    """Stores `chunks` under `key` for CACHE_TTL seconds."""
+    client = _get_client()
+    if client is None:
+        return
+    try:
+        client.setex(key, CACHE_TTL, json.dumps(chunks))
+    except redis.RedisError:
+        pass
@@ -1,48 +1,113 @@
-import docx
+import posixpath
+import zipfile
+
+from lxml import etree
+
+from md_utils import md_table
+
+# Read WordprocessingML straight from the .docx zip with lxml instead of going
+# through python-docx, whose Paragraph/Table/_Cell wrappers re-walk the XML on
+# every `.text`/`.cells` access.
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+NS = {'w': W_NS}
+OFFICE_DOCUMENT_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+
+P_TAG = f'{{{W_NS}}}p'
+TBL_TAG = f'{{{W_NS}}}tbl'
+
+BODY_XPATH = etree.XPath('/w:document/w:body/*', namespaces=NS)
+RUN_CONTENT_XPATH = etree.XPath('w:r/* | w:hyperlink/w:r/*', namespaces=NS)
+ROW_XPATH = etree.XPath('w:tr', namespaces=NS)
+CELL_XPATH = etree.XPath('w:tc', namespaces=NS)
+CELL_P_XPATH = etree.XPath('w:p', namespaces=NS)
+GRID_BEFORE_XPATH = etree.XPath('string(w:trPr/w:gridBefore/@w:val)', namespaces=NS)
+GRID_SPAN_XPATH = etree.XPath('string(w:tcPr/w:gridSpan/@w:val)', namespaces=NS)
+VMERGE_XPATH = etree.XPath('w:tcPr/w:vMerge', namespaces=NS)
+
+# Text equivalents of run content other than <w:t>, as in python-docx
+RUN_CHAR_MAP = {
+    f'{{{W_NS}}}tab': '\t',
+    f'{{{W_NS}}}ptab': '\t',
+    f'{{{W_NS}}}cr': '\n',
+    f'{{{W_NS}}}noBreakHyphen': '-',
+}
+T_TAG = f'{{{W_NS}}}t'
+BR_TAG = f'{{{W_NS}}}br'
+BR_TYPE_ATTR = f'{{{W_NS}}}type'
+
+# Never resolve external entities from an untrusted document
+XML_PARSER = etree.XMLParser(resolve_entities=False)
+
+def load_document_xml(file_path):
+    """
+    Returns the parsed main document part of a .docx file.
+    The part is located via the package relationships rather than assuming
+    'word/document.xml'.
+    """
+    with zipfile.ZipFile(file_path) as z:
+        part_name = 'word/document.xml'
+        if '_rels/.rels' in z.namelist():
+            rels = etree.fromstring(z.read('_rels/.rels'), XML_PARSER)
+            for rel in rels:
+                if rel.get('Type') == OFFICE_DOCUMENT_REL:
+                    part_name = posixpath.normpath(rel.get('Target').lstrip('/'))
+                    break
+        with z.open(part_name) as f:
+            return etree.parse(f, XML_PARSER)
+
+def paragraph_text(p):
+    """Text of a <w:p>, matching python-docx `Paragraph.text`."""
+    parts = []
+    for e in RUN_CONTENT_XPATH(p):
+        if e.tag == T_TAG:
+            if e.text:
+                parts.append(e.text)
+        elif e.tag == BR_TAG:
+            # Only line breaks become text; page/column breaks are dropped
+            if e.get(BR_TYPE_ATTR, 'textWrapping') == 'textWrapping':
+                parts.append('\n')
+        elif e.tag in RUN_CHAR_MAP:
+            parts.append(RUN_CHAR_MAP[e.tag])
+    return "".join(parts)
+
+def table_rows(tbl):
+    """
+    Yield each row of *tbl* as a list of cell texts, one per grid column.
+    Mirrors python-docx `row.cells`: horizontally merged cells repeat their
+    text and vertically merged cells repeat the text of the cell above.
+    """
+    above = {}  # grid column -> text of the cell above
+    for tr in ROW_XPATH(tbl):
+        row_data = []
+        col = int(GRID_BEFORE_XPATH(tr) or 0)
+        for tc in CELL_XPATH(tr):
+            span = int(GRID_SPAN_XPATH(tc) or 1)
+            vmerge = VMERGE_XPATH(tc)
+            if vmerge and vmerge[0].get(f'{{{W_NS}}}val', 'continue') == 'continue':
+                text = above.get(col, '')
+            else:
+                text = "\n".join(paragraph_text(p) for p in CELL_P_XPATH(tc)).strip().replace('\n', ' ')
+            for _ in range(span):
+                above[col] = text
+                row_data.append(text)
+                col += 1
+        yield row_data
 
 def parse_docx_to_chunks(file_path, document_id):
     """
     Parses a local DOCX file into chunks.
     """
-    doc = docx.Document(file_path)
+    tree = load_document_xml(file_path)
     chunks = []
     
-    # We'll iterate through the document's block-level elements (paragraphs and tables)
-    # in the order they appear. However, python-docx separates them.
-    # A common approach to preserve order is to iterate through the element tree,
-    # but for simplicity and robustness, we can process paragraphs and tables separately
-    # or try to interleave them if order is strictly required. 
-    # Given the "chunking" goal, processing paragraphs then tables (or vice versa) 
-    # might lose context. 
-    # Let's try to respect document order by iterating over `doc.element.body`.
+    # Iterate over the body's block-level elements (paragraphs and tables)
+    # in document order so tables keep their surrounding context.
     
-    # Actually, a simpler robust way for RAG chunking often involves just text extraction
-    # but preserving tables is key here.
-    # Let's iterate over all block elements in order.
-    
-    def iter_block_items(parent):
-        """
-        Yield each paragraph and table child within *parent*, in document order.
-        Each item will be an instance of either Table or Paragraph.
-        """
-        if isinstance(parent, docx.document.Document):
-            parent_elm = parent.element.body
-        elif isinstance(parent, docx.table._Cell):
-            parent_elm = parent._tc
-        else:
-            raise ValueError("something's not right")
-
-        for child in parent_elm.iterchildren():
-            if isinstance(child, docx.oxml.text.paragraph.CT_P):
-                yield docx.text.paragraph.Paragraph(child, parent)
-            elif isinstance(child, docx.oxml.table.CT_Tbl):
-                yield docx.table.Table(child, parent)
-
     current_text_block = []
     
-    for block in iter_block_items(doc):
-        if isinstance(block, docx.text.paragraph.Paragraph):
-            text = block.text.strip()
+    for child in BODY_XPATH(tree):
+        if child.tag == P_TAG:
+            text = paragraph_text(child).strip()
             if text:
                 # Heuristic: if it looks like a header (short, maybe bold?), treat as separate chunk?
                 # For now, let's just accumulate text until a reasonable break or change in type.
@@ -57,42 +122,19 @@ def parse_docx_to_chunks(file_path, document_id):
                     }
                 })
         
-        elif isinstance(block, docx.table.Table):
+        elif child.tag == TBL_TAG:
             # Process Table
             # Convert to Markdown
-            rows = block.rows
-            if not rows:
-                continue
-                
-            # Calculate max columns (handling merged cells is tricky in docx, 
-            # but let's assume a simple grid for now or just take the max cells in a row)
-            # python-docx handles merged cells by repeating the cell object.
-            
-            grid_data = []
-            for row in rows:
-                row_data = [cell.text.strip().replace('\n', ' ') for cell in row.cells]
-                grid_data.append(row_data)
+            grid_data = list(table_rows(child))
             
             if not grid_data:
                 continue
                 
-            # Generate Markdown
-            # We need to normalize column counts for a valid MD table
-            max_cols = max(len(r) for r in grid_data)
-            
-            md_lines = []
-            # Header
-            header_cells = grid_data[0] + [''] * (max_cols - len(grid_data[0]))
-            md_lines.append("| " + " | ".join(header_cells) + " |")
-            # Separator
-            md_lines.append("| " + " | ".join(['---'] * max_cols) + " |")
-            # Body
-            for r in grid_data[1:]:
-                padded_row = r + [''] * (max_cols - len(r))
-                md_lines.append("| " + " | ".join(padded_row) + " |")
+            # Generate Markdown (rows of different lengths are padded)
+            table_md = md_table(grid_data)
             
             chunks.append({
-                "text": "\n".join(md_lines),
+                "text": table_md,
                 "metadata": {
                     "document_id": document_id,
                     "type": "table"
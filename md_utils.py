@@ -0,0 +1,25 @@
+import io
+
+def md_table(grid):
+    """
+    Renders a list of rows (lists of cell strings) as a Markdown table.
+    The first row is the header. Short rows are padded with empty cells so
+    every row has the same column count.
+
+    Output is storage-optimized: cells are not padded to a common width and
+    the separator uses a single '---' per column. Aligned columns only help
+    human readers and cost extra tokens when the chunk is embedded.
+    """
+    max_cols = max(len(row) for row in grid)
+
+    def padded(row):
+        return row if len(row) == max_cols else row + [''] * (max_cols - len(row))
+
+    buf = io.StringIO()
+    buf.write("| " + " | ".join(padded(grid[0])) + " |\n")
+    buf.write("| " + " | ".join(['---'] * max_cols) + " |")
+    for row in grid[1:]:
+        buf.write("\n| ")
+        buf.write(" | ".join(padded(row)))
+        buf.write(" |")
+    return buf.getvalue()
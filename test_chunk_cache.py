@@ -0,0 +1,69 @@
+import chunk_cache
+
+class StubRedis:
+    """In-memory stand-in for the redis client; records setex calls."""
+    def __init__(self):
+        self.store = {}
+        self.setex_calls = []
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def setex(self, key, ttl, value):
+        self.setex_calls.append((key, ttl))
+        self.store[key] = value
+
+def test_round_trip_with_ttl(monkeypatch):
+    stub = StubRedis()
+    monkeypatch.setattr(chunk_cache, '_get_client', lambda: stub)
+    monkeypatch.setattr(chunk_cache, 'CACHE_TTL', 3600)
+    chunks = [{"text": "hello", "metadata": {"document_id": "doc", "page": 1, "type": "text_block"}}]
+    key = chunk_cache.cache_key("doc", "abc123")
+
+    assert chunk_cache.enabled()
+    assert chunk_cache.get(key) is None
+    chunk_cache.put(key, chunks)
+
+    assert chunk_cache.get(key) == chunks
+    assert stub.setex_calls == [(key, 3600)]
+    assert key == f"textract:doc:abc123:{chunk_cache.FEATURE_VERSION}"
+
+def test_no_op_without_client(monkeypatch):
+    monkeypatch.setattr(chunk_cache, '_get_client', lambda: None)
+
+    assert not chunk_cache.enabled()
+    chunk_cache.put("key", [{"text": "x"}])
+    assert chunk_cache.get("key") is None
+
+def test_file_fingerprint(tmp_path):
+    import hashlib
+    path = tmp_path / "doc.bin"
+    path.write_bytes(b"content")
+
+    assert chunk_cache.file_fingerprint(str(path)) == hashlib.sha256(b"content").hexdigest()
+
+class StubRedisModule:
+    """Stand-in for the redis module whose from_url rejects the URL."""
+    class RedisError(Exception):
+        pass
+
+    class Redis:
+        calls = []
+
+        @classmethod
+        def from_url(cls, url, **kwargs):
+            cls.calls.append(kwargs)
+            raise ValueError(f"Redis URL must specify a scheme: {url}")
+
+def test_malformed_url_disables_cache(monkeypatch):
+    monkeypatch.setattr(chunk_cache, 'redis', StubRedisModule)
+    monkeypatch.setattr(chunk_cache, 'REDIS_URL', 'localhost:6379')
+    monkeypatch.setattr(chunk_cache, '_client', None)
+    monkeypatch.setattr(chunk_cache, '_disabled', False)
+
+    assert not chunk_cache.enabled()
+    assert chunk_cache.get("key") is None
+    # Connects with short timeouts, and only tries once per process
+    assert StubRedisModule.Redis.calls == [
+        {'socket_connect_timeout': chunk_cache.REDIS_TIMEOUT, 'socket_timeout': chunk_cache.REDIS_TIMEOUT}
+    ]
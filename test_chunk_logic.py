@@ -1,5 +1,8 @@
 import json
-from chunk import parse_textract_layout_to_chunks
+import pytest
+import chunk
+from chunk import parse_textract_layout_to_chunks, TextractIndex
+from docx_parser import parse_docx_to_chunks
 
 def test_merged_cells():
     # Mock Textract Response with a 2x2 table where the first row is merged across 2 columns
@@ -75,5 +78,343 @@ def test_merged_cells():
     
     print("\nSUCCESS: Merged cell logic verified!")
 
+def test_overlapping_span_last_cell_wins():
+    # Wonky Textract output: cell-1 claims 2 columns but cell-2 is anchored in
+    # the second one. The cell later in TABLE child order wins the slot.
+    mock_response = {
+        'Blocks': [
+            {'Id': 'table-1', 'BlockType': 'TABLE', 'Relationships': [{'Type': 'CHILD', 'Ids': ['cell-1', 'cell-2']}]},
+            {'Id': 'cell-1', 'BlockType': 'CELL', 'RowIndex': 1, 'ColumnIndex': 1, 'RowSpan': 1, 'ColumnSpan': 2,
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-1']}]},
+            {'Id': 'cell-2', 'BlockType': 'CELL', 'RowIndex': 1, 'ColumnIndex': 2, 'RowSpan': 1, 'ColumnSpan': 1,
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-2']}]},
+            {'Id': 'word-1', 'BlockType': 'WORD', 'Text': 'Wide'},
+            {'Id': 'word-2', 'BlockType': 'WORD', 'Text': 'Late'},
+        ]
+    }
+
+    chunks = parse_textract_layout_to_chunks(mock_response, "test-doc")
+
+    assert chunks[0]['text'].split('\n')[0] == "| Wide | Late |", chunks[0]['text']
+
+def test_duplicate_anchor_with_gap():
+    # Cell count matches the grid size, but (1,1) appears twice and (1,2) is
+    # missing: the later duplicate wins and the gap stays empty.
+    mock_response = {
+        'Blocks': [
+            {'Id': 'table-1', 'BlockType': 'TABLE', 'Relationships': [{'Type': 'CHILD', 'Ids': ['cell-1', 'cell-2', 'cell-3', 'cell-4']}]},
+            {'Id': 'cell-1', 'BlockType': 'CELL', 'RowIndex': 1, 'ColumnIndex': 1, 'Relationships': [{'Type': 'CHILD', 'Ids': ['word-1']}]},
+            {'Id': 'cell-2', 'BlockType': 'CELL', 'RowIndex': 1, 'ColumnIndex': 1, 'Relationships': [{'Type': 'CHILD', 'Ids': ['word-2']}]},
+            {'Id': 'cell-3', 'BlockType': 'CELL', 'RowIndex': 2, 'ColumnIndex': 1, 'Relationships': [{'Type': 'CHILD', 'Ids': ['word-3']}]},
+            {'Id': 'cell-4', 'BlockType': 'CELL', 'RowIndex': 2, 'ColumnIndex': 2, 'Relationships': [{'Type': 'CHILD', 'Ids': ['word-4']}]},
+            {'Id': 'word-1', 'BlockType': 'WORD', 'Text': 'a'},
+            {'Id': 'word-2', 'BlockType': 'WORD', 'Text': 'b'},
+            {'Id': 'word-3', 'BlockType': 'WORD', 'Text': 'c'},
+            {'Id': 'word-4', 'BlockType': 'WORD', 'Text': 'd'},
+        ]
+    }
+
+    chunks = parse_textract_layout_to_chunks(mock_response, "test-doc")
+
+    assert chunks[0]['text'] == "| b |  |\n| --- | --- |\n| c | d |", chunks[0]['text']
+
+def test_merged_cells_html():
+    # Same 2x2 table as above, serialized as HTML: the merged header keeps
+    # its colspan instead of being replicated.
+    mock_response = {
+        'Blocks': [
+            {'Id': 'table-1', 'BlockType': 'TABLE', 'Relationships': [{'Type': 'CHILD', 'Ids': ['cell-1', 'cell-2', 'cell-3']}]},
+            {'Id': 'cell-1', 'BlockType': 'CELL', 'RowIndex': 1, 'ColumnIndex': 1, 'RowSpan': 1, 'ColumnSpan': 2,
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-1']}]},
+            {'Id': 'cell-2', 'BlockType': 'CELL', 'RowIndex': 2, 'ColumnIndex': 1, 'RowSpan': 1, 'ColumnSpan': 1,
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-2']}]},
+            {'Id': 'cell-3', 'BlockType': 'CELL', 'RowIndex': 2, 'ColumnIndex': 2, 'RowSpan': 1, 'ColumnSpan': 1,
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-3']}]},
+            {'Id': 'word-1', 'BlockType': 'WORD', 'Text': 'Header'},
+            {'Id': 'word-2', 'BlockType': 'WORD', 'Text': 'A'},
+            {'Id': 'word-3', 'BlockType': 'WORD', 'Text': 'B&C'}
+        ]
+    }
+
+    chunks = parse_textract_layout_to_chunks(mock_response, "test-doc", table_format='html')
+
+    expected = '<table><tr><td colspan="2">Header</td></tr><tr><td>A</td><td>B&amp;C</td></tr></table>'
+    assert chunks[0]['text'] == expected, chunks[0]['text']
+
+def test_html_gaps_and_rowspan():
+    # (1,1) is missing, so 'b' must stay in column 2. 'x' spans rows 2-3,
+    # so row 3 starts at column 2 without an extra <td>. (3,2) is listed
+    # twice and the later cell wins.
+    cells = [
+        ('cell-b', 1, 2, 1, 'b'),
+        ('cell-x', 2, 1, 2, 'x'),
+        ('cell-y', 2, 2, 1, 'y'),
+        ('cell-z1', 3, 2, 1, 'old'),
+        ('cell-z2', 3, 2, 1, 'new'),
+    ]
+    blocks = [{'Id': 'table-1', 'BlockType': 'TABLE',
+               'Relationships': [{'Type': 'CHILD', 'Ids': [c[0] for c in cells]}]}]
+    for cid, r, col, rs, text in cells:
+        blocks.append({'Id': cid, 'BlockType': 'CELL', 'RowIndex': r, 'ColumnIndex': col, 'RowSpan': rs,
+                       'Relationships': [{'Type': 'CHILD', 'Ids': [f'{cid}-w']}]})
+        blocks.append({'Id': f'{cid}-w', 'BlockType': 'WORD', 'Text': text})
+
+    chunks = parse_textract_layout_to_chunks({'Blocks': blocks}, "test-doc", table_format='html')
+
+    expected = ('<table><tr><td></td><td>b</td></tr>'
+                '<tr><td rowspan="2">x</td><td>y</td></tr>'
+                '<tr><td>new</td></tr></table>')
+    assert chunks[0]['text'] == expected, chunks[0]['text']
+
+def test_fallback_lines():
+    # No LAYOUT blocks: raw LINE fallback. The first LINE repeats the table's
+    # words and must be dropped; the rest split on a vertical gap and a page break.
+    mock_response = {
+        'Blocks': [
+            {
+                'Id': 'table-1',
+                'BlockType': 'TABLE',
+                'Page': 1,
+                'Relationships': [{'Type': 'CHILD', 'Ids': ['cell-1']}]
+            },
+            {
+                'Id': 'cell-1',
+                'BlockType': 'CELL',
+                'RowIndex': 1,
+                'ColumnIndex': 1,
+                'Relationships': [{'Type': 'CHILD', 'Ids': ['word-1']}]
+            },
+            {'Id': 'word-1', 'BlockType': 'WORD', 'Text': 'Total'},
+            {'Id': 'word-2', 'BlockType': 'WORD', 'Text': 'Intro'},
+            {'Id': 'word-3', 'BlockType': 'WORD', 'Text': 'text'},
+            {'Id': 'word-4', 'BlockType': 'WORD', 'Text': 'Next'},
+            {'Id': 'word-5', 'BlockType': 'WORD', 'Text': 'Later'},
+            # Lines
+            {'Id': 'line-1', 'BlockType': 'LINE', 'Text': 'Total', 'Page': 1,
+             'Geometry': {'BoundingBox': {'Top': 0.05}},
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-1']}]},
+            {'Id': 'line-2', 'BlockType': 'LINE', 'Text': 'Intro', 'Page': 1,
+             'Geometry': {'BoundingBox': {'Top': 0.10}},
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-2']}]},
+            {'Id': 'line-3', 'BlockType': 'LINE', 'Text': 'text', 'Page': 1,
+             'Geometry': {'BoundingBox': {'Top': 0.12}},
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-3']}]},
+            {'Id': 'line-4', 'BlockType': 'LINE', 'Text': 'Next', 'Page': 1,
+             'Geometry': {'BoundingBox': {'Top': 0.50}},
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-4']}]},
+            {'Id': 'line-5', 'BlockType': 'LINE', 'Text': 'Later', 'Page': 2,
+             'Geometry': {'BoundingBox': {'Top': 0.51}},
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-5']}]},
+        ]
+    }
+
+    chunks = parse_textract_layout_to_chunks(mock_response, "test-doc")
+    text_chunks = [(c['text'], c['metadata']['page']) for c in chunks if c['metadata']['type'] == 'text_block']
+
+    assert text_chunks == [("Intro text", 1), ("Next", 1), ("Later", 2)], text_chunks
+
+def test_index_across_pages():
+    # Pagination can split a cell from its words; the index must resolve them
+    # once all pages are in.
+    page_1 = [
+        {'Id': 'table-1', 'BlockType': 'TABLE', 'Relationships': [{'Type': 'CHILD', 'Ids': ['cell-1']}]},
+        {'Id': 'cell-1', 'BlockType': 'CELL', 'RowIndex': 1, 'ColumnIndex': 1,
+         'Relationships': [{'Type': 'CHILD', 'Ids': ['word-1', 'word-2']}]},
+    ]
+    page_2 = [
+        {'Id': 'word-1', 'BlockType': 'WORD', 'Text': 'Net'},
+        {'Id': 'word-2', 'BlockType': 'WORD', 'Text': 'Income'},
+    ]
+
+    idx = TextractIndex()
+    idx.add_page(page_1)
+    idx.add_page(page_2)
+    chunks = parse_textract_layout_to_chunks(idx, "test-doc")
+
+    assert len(idx) == 4
+    assert chunks[0]['text'].split('\n')[0] == "| Net Income |", chunks[0]['text']
+
+def test_layout_skips_table_text():
+    # A LAYOUT_TEXT block that mostly repeats table words is dropped;
+    # a LAYOUT_TITLE with its own words is kept.
+    mock_response = {
+        'Blocks': [
+            {'Id': 'table-1', 'BlockType': 'TABLE', 'Relationships': [{'Type': 'CHILD', 'Ids': ['cell-1']}]},
+            {'Id': 'cell-1', 'BlockType': 'CELL', 'RowIndex': 1, 'ColumnIndex': 1,
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-1', 'word-2']}]},
+            {'Id': 'title-1', 'BlockType': 'LAYOUT_TITLE', 'Page': 1,
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['line-1']}]},
+            {'Id': 'text-1', 'BlockType': 'LAYOUT_TEXT', 'Page': 1,
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['line-2']}]},
+            {'Id': 'line-1', 'BlockType': 'LINE', 'Text': 'Annual Report',
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-3', 'word-4']}]},
+            {'Id': 'line-2', 'BlockType': 'LINE', 'Text': 'Net Income Total',
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['word-1', 'word-2', 'word-5']}]},
+            {'Id': 'word-1', 'BlockType': 'WORD', 'Text': 'Net'},
+            {'Id': 'word-2', 'BlockType': 'WORD', 'Text': 'Income'},
+            {'Id': 'word-3', 'BlockType': 'WORD', 'Text': 'Annual'},
+            {'Id': 'word-4', 'BlockType': 'WORD', 'Text': 'Report'},
+            {'Id': 'word-5', 'BlockType': 'WORD', 'Text': 'Total'},
+        ]
+    }
+
+    chunks = parse_textract_layout_to_chunks(mock_response, "test-doc")
+    layout_chunks = [(c['text'], c['metadata']['type']) for c in chunks if c['metadata']['type'] != 'table']
+
+    assert layout_chunks == [("Annual Report", "layout_title")], layout_chunks
+
+class StubTextract:
+    """
+    Minimal stand-in for the Textract client. Each JobId maps to the list of
+    JobStatus values reported by successive polls; finished jobs return
+    `pages` result pages (linked by NextToken), each holding a single LINE.
+    """
+    def __init__(self, statuses, pages=1):
+        self.statuses = statuses
+        self.pages = pages
+        self.tokens = []
+
+    def start_document_analysis(self, DocumentLocation, FeatureTypes):
+        return {'JobId': DocumentLocation['S3Object']['Name']}
+
+    def get_document_analysis(self, JobId, MaxResults=None, NextToken=None):
+        if MaxResults is None:
+            pending = self.statuses[JobId]
+            status = pending.pop(0) if len(pending) > 1 else pending[0]
+            return {'JobStatus': status, 'StatusMessage': f"{JobId} broke"}
+        self.tokens.append(NextToken)
+        page = int(NextToken) if NextToken else 1
+        text = JobId if self.pages == 1 else f"{JobId} page {page}"
+        response = {
+            'JobStatus': 'SUCCEEDED',
+            'Blocks': [{'Id': f'{JobId}-line-{page}', 'BlockType': 'LINE', 'Text': text,
+                        'Page': page, 'Geometry': {'BoundingBox': {'Top': 0.1}}}]
+        }
+        if page < self.pages:
+            response['NextToken'] = str(page + 1)
+        return response
+
+def test_wait_for_job_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(chunk, 'textract_client', StubTextract({'job': ['IN_PROGRESS'] * 4 + ['SUCCEEDED']}))
+    monkeypatch.setattr(chunk.time, 'sleep', sleeps.append)
+
+    chunk.wait_for_job('job', initial_poll=1.0, max_poll=3.0, poll_multiplier=1.5)
+
+    assert sleeps == [1.0, 1.5, 2.25, 3.0]
+
+def test_process_documents_isolates_failed_job(monkeypatch):
+    monkeypatch.setattr(chunk, 'textract_client', StubTextract({
+        'k1': ['SUCCEEDED'],
+        'bad': ['IN_PROGRESS', 'FAILED'],
+        'k2': ['SUCCEEDED'],
+    }))
+    monkeypatch.setattr(chunk.time, 'sleep', lambda s: None)
+
+    results, errors = chunk.process_documents(['k1', 'bad', 'k2'], bucket='bucket', max_workers=3)
+
+    assert [c['text'] for c in results['k1']] == ['k1']
+    assert [c['text'] for c in results['k2']] == ['k2']
+    assert list(errors) == ['bad']
+    assert isinstance(errors['bad'], RuntimeError)
+    assert "bad broke" in str(errors['bad'])
+
+def test_wait_for_job_failure_raises(monkeypatch):
+    monkeypatch.setattr(chunk, 'textract_client', StubTextract({'job': ['FAILED']}))
+
+    with pytest.raises(RuntimeError, match="job broke"):
+        chunk.wait_for_job('job')
+
+def test_get_full_results_pages_in_order(monkeypatch):
+    stub = StubTextract({'job': ['SUCCEEDED']}, pages=3)
+    monkeypatch.setattr(chunk, 'textract_client', stub)
+
+    idx = chunk.get_full_results('job')
+
+    # Every page is requested once, following NextToken, and indexed in order
+    assert stub.tokens == [None, '2', '3']
+    assert len(idx) == 3
+    assert [b['Page'] for b in idx.type_index['LINE']] == [1, 2, 3]
+
+    chunks = parse_textract_layout_to_chunks(idx, "test-doc")
+    assert [(c['text'], c['metadata']['page']) for c in chunks] == [
+        ("job page 1", 1), ("job page 2", 2), ("job page 3", 3)
+    ]
+
+def test_docx_sample_document():
+    chunks = parse_docx_to_chunks('test_doc.docx', "test-doc")
+
+    assert [(c['text'], c['metadata']['type']) for c in chunks] == [
+        ("Test Document", "text_block"),
+        ("This is a regular paragraph with some text.", "text_block"),
+        ("Section 1", "text_block"),
+        ("Another paragraph in section 1.", "text_block"),
+        ("| Header 1 | Header 2 | Header 3 |\n"
+         "| --- | --- | --- |\n"
+         "| R1C1 | R1C2 | R1C3 |\n"
+         "| R2C1 | R2C2 | R2C3 |", "table"),
+    ]
+    assert all(c['metadata']['document_id'] == "test-doc" for c in chunks)
+
+def test_docx_merged_cells_and_run_content(tmp_path):
+    # Built with python-docx so the XML matches what Word-like writers emit
+    import docx
+    from docx.enum.text import WD_BREAK
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    doc = docx.Document()
+
+    # Tab, line break and page break inside runs, plus text inside a hyperlink
+    p = doc.add_paragraph('Intro ')
+    run = p.add_run('tab')
+    run.add_tab()
+    run.add_text('after')
+    run.add_break()
+    run.add_text('line2')
+    run.add_break(WD_BREAK.PAGE)
+    hyperlink = OxmlElement('w:hyperlink')
+    link_run = OxmlElement('w:r')
+    link_text = OxmlElement('w:t')
+    link_text.text = ' link'
+    link_text.set(qn('xml:space'), 'preserve')
+    link_run.append(link_text)
+    hyperlink.append(link_run)
+    p._p.append(hyperlink)
+
+    # 4x3 table: horizontal merge, vertical merge and a 2x2 block merge
+    table = doc.add_table(rows=4, cols=3)
+    for r in range(4):
+        for c in range(3):
+            table.cell(r, c).text = f"R{r}C{c}"
+    table.cell(0, 0).merge(table.cell(0, 1)).text = "H"
+    table.cell(0, 2).merge(table.cell(1, 2)).text = "V"
+    block = table.cell(2, 0).merge(table.cell(3, 1))
+    block.text = "B"
+    block.add_paragraph("second")
+
+    path = tmp_path / "merged.docx"
+    doc.save(str(path))
+
+    chunks = parse_docx_to_chunks(str(path), "merged-doc")
+
+    assert [c['metadata']['type'] for c in chunks] == ["text_block", "table"]
+    assert chunks[0]['text'] == "Intro tab\tafter\nline2 link"
+    assert chunks[1]['text'] == (
+        "| H | H | V |\n"
+        "| --- | --- | --- |\n"
+        "| R1C0 | R1C1 | V |\n"
+        "| B second | B second | R2C2 |\n"
+        "| B second | B second | R3C2 |"
+    )
+
 if __name__ == "__main__":
     test_merged_cells()
+    test_overlapping_span_last_cell_wins()
+    test_duplicate_anchor_with_gap()
+    test_merged_cells_html()
+    test_html_gaps_and_rowspan()
+    test_fallback_lines()
+    test_index_across_pages()
+    test_layout_skips_table_text()
+    test_docx_sample_document()